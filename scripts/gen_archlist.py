@@ -25,8 +25,10 @@ from __future__ import division, print_function
 
 import argparse
 import collections
+import functools
 import logging
 import logging.config
+import multiprocessing
 
 import portage
 
@@ -35,15 +37,21 @@ logger = logging.getLogger('gen_archlist')
 #############
 # Constants #
 #############
+PORTDB = portage.portdb
 # GNOME_OVERLAY = PORTDB.getRepositoryPath('gnome')
-portage.portdb.porttrees = [portage.settings['PORTDIR']]
-STABLE_ARCHES = ('alpha', 'amd64', 'arm', 'hppa', 'ia64', 'ppc', 'ppc64',
-                 'sparc', 'x86')
-UNSTABLE_ARCHES = ('~alpha', '~amd64', '~arm', '~hppa', '~ia64', '~m68k',
-                   '~ppc', '~ppc64', '~s390', '~sh', '~sparc', '~x86',
-                   '~x86-fbsd')
-ALL_ARCHES = STABLE_ARCHES + UNSTABLE_ARCHES
-SYSTEM_PACKAGES = []
+PORTDB.porttrees = [portage.settings['PORTDIR']]
+STABLE_ARCHES = frozenset(('alpha', 'amd64', 'arm', 'hppa', 'ia64', 'ppc',
+                           'ppc64', 'sparc', 'x86'))
+UNSTABLE_ARCHES = frozenset(('~alpha', '~amd64', '~arm', '~hppa', '~ia64',
+                             '~m68k', '~ppc', '~ppc64', '~s390', '~sh',
+                             '~sparc', '~x86', '~x86-fbsd'))
+ALL_ARCHES = STABLE_ARCHES | UNSTABLE_ARCHES
+# Metadata keys fetched at once for every CPV we look at
+METADATA_KEYS = ('KEYWORDS', 'SLOT', 'DEPEND', 'RDEPEND', 'PDEPEND')
+# Prefixes of packages whose dependencies are not checked
+SYSTEM_PACKAGES = ()
+# States of the best version selection in get_best_deps()
+BEST_INIT, BEST_FOUND, BEST_ALREADY, BEST_NONE = range(4)
 
 ############
 # Settings #
@@ -73,12 +81,63 @@ else:
 ####################
 # Define Functions #
 ####################
+def memoize(func):
+    """Cache the return values of `func`, keyed by its (hashable) arguments."""
+    cache = {}
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        try:
+            return cache[args]
+        except KeyError:
+            ret = cache[args] = func(*args)
+            return ret
+
+    return wrapper
+
+
+@memoize
+def get_metadata(cpv):
+    """Return a dict of the METADATA_KEYS of `cpv`.
+
+    All the keys are fetched with a single aux_get() call, and cached.
+    """
+    return dict(zip(METADATA_KEYS, PORTDB.aux_get(cpv, list(METADATA_KEYS))))
+
+
+@memoize
+def xmatch_all(atom):
+    """Return a tuple of all the CPVs matching `atom`."""
+    return tuple(PORTDB.xmatch('match-all', atom))
+
+
+@memoize
+def get_dep_atoms(depstr):
+    """Return the set of atoms found in the dependency string `depstr`.
+
+    All USE-conditional deps are considered, and || deps are flattened.
+    """
+    try:
+        atoms = portage.dep.use_reduce(depstr, matchall=True, flat=True,
+                                       token_class=portage.dep.Atom)
+    except portage.exception.InvalidDependString as err:
+        logger.warn('Invalid dependency string: %s', err)
+        return frozenset()
+    return frozenset(atom for atom in atoms if atom != '||')
+
+
+@memoize
+def get_version(cpv):
+    """Return the version of `cpv`."""
+    return portage.versions.cpv_getversion(cpv)
+
+
 def make_unstable(kws):
-    """Transform `kws` into a list of unstable keywords."""
-    return set([
+    """Transform `kws` into a set of unstable keywords."""
+    return frozenset(
         kwd if kwd.startswith('~') else '~' + kwd
         for kwd in kws
-    ])
+    )
 
 
 def belongs_release(cpv, release):
@@ -86,45 +145,32 @@ def belongs_release(cpv, release):
     # FIXME: This failure function needs better logic
     if CHECK_DEPS:
         raise Exception('This function is utterly useless with RECURSIVE mode')
-    return portage.versions.cpv_getversion(cpv).startswith(release)
+    return get_version(cpv).startswith(release)
 
 
 def issystempackage(cpv):
-    for i in SYSTEM_PACKAGES:
-        if cpv.startswith(i):
-            return True
-    return False
+    return cpv.startswith(SYSTEM_PACKAGES)
 
 
 def get_kws(cpv, arches=ARCHES):
     """Return keywords of `cpv` filtered by `arches`."""
-    return set([
-        kwd for kwd in portage.portdb.aux_get(cpv, ['KEYWORDS'])[0].split()
-        if kwd in arches
-    ])
-
+    if not isinstance(arches, frozenset):
+        arches = frozenset(arches)
+    return _get_kws(cpv, arches)
 
-def can_stabilize_cpv(cpv, release=None):
-    """Whether `cpv` matches stabilization criteria.
 
-    `cpv` must:
-    * belong to the release
-    * not be p.masked
-    * have keywords
-    """
-    if release and not belongs_release(cpv, release):
-        return False
-    if not portage.portdb.visible([cpv]):
-        return False
-    if not get_kws(cpv, arches=ALL_ARCHES):
-        return False
-    return True
+@memoize
+def _get_kws(cpv, arches):
+    return arches.intersection(get_metadata(cpv)['KEYWORDS'].split())
 
 
 def match_wanted_atoms(atom, release=None):
     """Return a list of CPV matching `atom`.
 
-    If `release` is provided, CPVs are filtered against it.
+    Matching CPVs must:
+    * belong to the release, if `release` is provided
+    * not be p.masked
+    * have keywords
 
     The list is sorted by descending order of version.
     """
@@ -132,9 +178,15 @@ def match_wanted_atoms(atom, release=None):
     if atom.startswith('!'):
         return []
 
+    cpvs = xmatch_all(atom)
+    # Check visibility of all the matches at once
+    visible = set(PORTDB.visible(list(cpvs)))
+
     return [
-        cpv for cpv in reversed(portage.portdb.xmatch('match-all', atom))
-        if can_stabilize_cpv(cpv, release)
+        cpv for cpv in reversed(cpvs)
+        if cpv in visible and
+        (not release or belongs_release(cpv, release)) and
+        get_kws(cpv, arches=ALL_ARCHES)
     ]
 
 
@@ -143,32 +195,36 @@ def get_best_deps(cpv, kws, release=None):
     Returns a list of the best deps of a cpv, optionally matching a release,
     and with max of the specified keywords
     """
+    return _get_best_deps(cpv, frozenset(kws), release)
+
+
+@memoize
+def _get_best_deps(cpv, kws, release):
     # Take raw dependency strings and convert it to a list of atoms
-    atoms = portage.portdb.aux_get(cpv, ['DEPEND', 'RDEPEND', 'PDEPEND'])
-    atoms = ' '.join(atoms).split()  # consolidate atoms
-    atoms = list(set(atoms))  # de-duplicate
+    metadata = get_metadata(cpv)
+    atoms = get_dep_atoms(' '.join(
+        metadata[key] for key in ('DEPEND', 'RDEPEND', 'PDEPEND')
+    ))
 
     deps = set()
+    unstable_kws = make_unstable(kws)
+    all_kws = kws | unstable_kws
 
     for atom in atoms:
-        if not portage.isvalidatom(atom):
-            continue
-
         cpvs = match_wanted_atoms(atom, release)
         if not cpvs:
             logger.debug('Encountered an irrelevant atom: %s', atom)
             continue
 
-        best_cpv_kws = ['', []]
+        state, best_cpv, best_kws = BEST_INIT, None, frozenset()
         for candidate_cpv in cpvs:
             if STABLE:
-                # Check that this version has unstable keywords
-                unstable_kws = make_unstable(kws)
-                cur_unstable_kws = make_unstable(
-                    get_kws(candidate_cpv, arches=kws | unstable_kws)
-                )
-                if cur_unstable_kws.intersection(unstable_kws) != unstable_kws:
-                    best_cpv_kws[0] = 'none'
+                # Check that this version has unstable keywords, a stable
+                # keyword counting as its unstable one
+                cur_kws = get_kws(candidate_cpv, arches=all_kws)
+                if not all(kwd in cur_kws or kwd[1:] in cur_kws
+                           for kwd in unstable_kws):
+                    state = BEST_NONE
                     logger.debug('Insufficiant unstable keywords in: %s',
                                  candidate_cpv)
                     continue
@@ -176,24 +232,26 @@ def get_best_deps(cpv, kws, release=None):
             candidate_kws = get_kws(candidate_cpv, arches=kws)
             if candidate_kws == kws:
                 # This dep already has all requested keywords
-                best_cpv_kws[0] = 'alreadythere'
+                state = BEST_ALREADY
                 break
 
             # Select the version which needs least new keywords
-            if len(candidate_kws) > len(best_cpv_kws[1]):
-                best_cpv_kws = [candidate_cpv, candidate_kws]
-            elif not best_cpv_kws[0]:
+            if len(candidate_kws) > len(best_kws):
+                state, best_cpv, best_kws = (BEST_FOUND, candidate_cpv,
+                                             candidate_kws)
+            elif state == BEST_INIT:
                 # This means that none of the versions have any of the stable
                 # keywords that *we checked* (i.e. kws).
-                best_cpv_kws = [candidate_cpv, []]
+                state, best_cpv, best_kws = (BEST_FOUND, candidate_cpv,
+                                             frozenset())
 
-        if best_cpv_kws[0] == 'alreadythere':
+        if state == BEST_ALREADY:
             logger.debug('DEP %s is already %s, ignoring', atom,
                          'stable' if STABLE else 'keyworded')
             continue
-        elif best_cpv_kws[0] == 'none':
+        elif state == BEST_NONE:
             continue
-        elif not best_cpv_kws[0]:
+        elif state == BEST_INIT:
             # We get this when the if STABLE: block above rejects everything.
             # This means that this atom does not have any versions with
             # unstable keywords matching the unstable keywords of the cpv
@@ -202,7 +260,7 @@ def get_best_deps(cpv, kws, release=None):
             # make such deps strict while parsing
             # XXX: We arbitrarily select the most recent version for this case
             deps.add(cpvs[0])
-        elif not best_cpv_kws[1]:
+        elif not best_kws:
             # This means that none of the versions have any of the stable
             # keywords that *we checked* (i.e. kws). Hence, we do another pass;
             # this time checking *all* keywords.
@@ -210,23 +268,22 @@ def get_best_deps(cpv, kws, release=None):
             # XXX: We duplicate some of the things from the for loop above
             # We don't need to duplicate anything that caused a 'continue' or
             # a 'break' above
-            cpvs = match_wanted_atoms(atom, release)
-            best_cpv_kws = ['', []]
+            best_cpv, best_kws = None, frozenset()
             for candidate_cpv in cpvs:
                 cur_kws = get_kws(candidate_cpv)
-                if len(cur_kws) > len(best_cpv_kws[1]):
-                    best_cpv_kws = [candidate_cpv, cur_kws]
-                elif not best_cpv_kws[0]:
+                if len(cur_kws) > len(best_kws):
+                    best_cpv, best_kws = candidate_cpv, cur_kws
+                elif best_cpv is None:
                     # This means that none of the versions have any of
                     # the stable keywords *at all*. No choice but to
                     # arbitrarily select the latest version in that case.
-                    best_cpv_kws = [candidate_cpv, []]
+                    best_cpv = candidate_cpv
 
-            deps.add(best_cpv_kws[0])
+            deps.add(best_cpv)
         else:
-            deps.add(best_cpv_kws[0])
+            deps.add(best_cpv)
 
-    return list(deps)
+    return tuple(deps)
 
 
 def max_kws(cpv, release=None):
@@ -240,9 +297,8 @@ def max_kws(cpv, release=None):
     Returns [] if current cpv has best keywords
     Returns None if no cpv has keywords
     """
-    current_kws = set(get_kws(cpv, arches=ALL_ARCHES))
+    current_kws = get_kws(cpv, arches=ALL_ARCHES)
     maximum_kws = set()  # Maximum keywords that a cpv has
-    missing_kws = set()
 
     # Build best keyword coverage for `cpv`
     for atom in match_wanted_atoms('<=' + cpv, release):
@@ -250,23 +306,20 @@ def max_kws(cpv, release=None):
 
         # Consider stable keywords only
         if STABLE:
-            kws = [kwd for kwd in kws if not kwd.startswith('~')]
+            kws -= UNSTABLE_ARCHES
 
-        maximum_kws.update(set(kws))
+        maximum_kws |= kws
 
-    # Build list of keywords missing to achieve best coverage
-    for kwd in maximum_kws:
-        # Skip stable keywords with no corresponding unstable keyword in `cpv`
-        if STABLE and '~' + kwd not in current_kws:
-            continue
-        missing_kws.add(kwd)
-
-    if maximum_kws:
-        return missing_kws
-    else:
+    if not maximum_kws:
         # No cpv has the keywords we need
         return None
 
+    # Build list of keywords missing to achieve best coverage
+    if STABLE:
+        # Skip stable keywords with no corresponding unstable keyword in `cpv`
+        return {kwd for kwd in maximum_kws if '~' + kwd in current_kws}
+    return maximum_kws
+
 
 # FIXME: This is broken
 def kws_wanted(current_kws, target_kws):
@@ -280,52 +333,53 @@ def kws_wanted(current_kws, target_kws):
     return wanted
 
 
-def gen_cpv_kws(cpv, kws_aim, depgraph, check_dependencies, new_release):
+def gen_cpv_kws(cpv, kws_aim, check_dependencies, new_release):
     """Build a list of CPV-Keywords.
 
     If `check_dependencies` is True, append dependencies that need to be
-    updated to the list.
+    updated to the list. Dependencies are listed before the CPVs pulling them.
     """
-    wanted = kws_wanted(get_kws(cpv, arches=ALL_ARCHES), kws_aim)
-
-    if not wanted:
-        # This happens when cpv has less keywords than kws_aim
-        # Usually happens when a dep was an || dep, or under a USE-flag
-        # which is masked in some profiles. We make all deps strict in
-        # get_best_deps()
-        # So... let's just stabilize it on all arches we can, and ignore for
-        # keywording since we have no idea about that.
-        if not STABLE:
-            logger.warn('MEH')
-            logger.info('DEP %s is already %s, ignoring', cpv,
-                        'stable' if STABLE else 'keyworded')
-            return None
-
-        wanted = get_kws(cpv, arches=make_unstable(kws_aim))
+    cpv_kw_list = []
+    depgraph = set()
+
+    # Walk the dependency graph depth-first, recording CPVs in pre-order
+    stack = [(cpv, kws_aim)]
+    while stack:
+        cpv, kws_aim = stack.pop()
+        if cpv in depgraph:
+            # XXX: assumes that `kws_aim` of previously added cpv is
+            #      larger than current
+            continue
+        depgraph.add(cpv)
+
+        wanted = kws_wanted(get_kws(cpv, arches=ALL_ARCHES), kws_aim)
+
+        if not wanted:
+            # This happens when cpv has less keywords than kws_aim
+            # Usually happens when a dep was an || dep, or under a USE-flag
+            # which is masked in some profiles. We make all deps strict in
+            # get_best_deps()
+            # So... let's just stabilize it on all arches we can, and ignore
+            # for keywording since we have no idea about that.
+            if not STABLE:
+                logger.warn('MEH')
+                logger.info('DEP %s is already %s, ignoring', cpv,
+                            'stable' if STABLE else 'keyworded')
+                continue
 
-    cpv_kw_list = [(cpv, wanted)]
+            wanted = get_kws(cpv, arches=make_unstable(kws_aim))
 
-    if check_dependencies and not issystempackage(cpv):
-        deps = get_best_deps(cpv, wanted, release=new_release)
-        logger.debug('Dependencies of %s are: %s', cpv, deps)
+        cpv_kw_list.append((cpv, wanted))
 
-        for dep in deps:
-            if dep in depgraph:
-                # XXX: assumes that `kws_aim` of previously added cpv is
-                #      larger than current
-                continue
+        if check_dependencies and not issystempackage(cpv):
+            deps = get_best_deps(cpv, wanted, release=new_release)
+            logger.debug('Dependencies of %s are: %s', cpv, deps)
 
-            depgraph.add(dep)
             # XXX: Assumes that dependencies are keyworded the same than cpv
-            dep_deps = gen_cpv_kws(dep, wanted, depgraph, check_dependencies,
-                                   new_release)
-            dep_deps.reverse()
-
-            for cpv_kw_tuple in dep_deps:
-                # Make sure we don't already have the same [(cpv, kws)]
-                if cpv_kw_tuple not in cpv_kw_list:
-                    cpv_kw_list.append(cpv_kw_tuple)
+            # Push in reverse order so that the first dep is walked first
+            stack.extend((dep, wanted) for dep in reversed(deps))
 
+    # Reversed pre-order puts every dependency before its dependents
     cpv_kw_list.reverse()
     return cpv_kw_list
 
@@ -344,12 +398,16 @@ def consolidate_dupes(cpv_kws):
 
     # Update cpv with their maximum request keywords
     clean_cpv_kws = []
+    seen = set()
     for dep_set in cpv_kws:
-        clean_cpv_kws.append([
-            (cpv, cpv_kws_dict.pop(cpv))
+        clean_dep_set = []
+        for cpv, _ in dep_set:
             # Keep only first occurence of cpv
-            for cpv, _ in dep_set if cpv in cpv_kws_dict
-        ])
+            if cpv in seen:
+                continue
+            seen.add(cpv)
+            clean_dep_set.append((cpv, cpv_kws_dict[cpv]))
+        clean_cpv_kws.append(clean_dep_set)
 
     return clean_cpv_kws
 
@@ -362,7 +420,7 @@ def get_per_slot_cpvs(cpvs):
     """
     slots = set()
     for cpv in cpvs:
-        slot = portage.portage.portdb.aux_get(cpv, ['SLOT'])[0]
+        slot = get_metadata(cpv)['SLOT']
         if slot in slots:
             continue
         slots.add(slot)
@@ -373,7 +431,7 @@ def append_slots(cpv_kws):
     """Append slots at the end of cpv atoms"""
     slotifyed_cpv_kws = []
     for cpv, kws in cpv_kws:
-        slot = portage.portage.portdb.aux_get(cpv, ['SLOT'])[0]
+        slot = get_metadata(cpv)['SLOT']
         cpv = "%s:%s" % (cpv, slot)
         slotifyed_cpv_kws.append([cpv, kws])
     return slotifyed_cpv_kws
@@ -391,17 +449,14 @@ def print_cpv_kws(cpv_kws):
             # Find the set of all kws listed
             kws_all.update(kws)
 
+    kws_all = sorted(kws_all)
+
     for dep_set in cpv_kws:
         for cpv, kws in dep_set:
-            pretty_line = cpv + ' ' * (max_len - len(cpv))
-
-            for kwd in sorted(kws_all):
-                if kwd in kws:
-                    pretty_line += ' ' + kwd
-                else:
-                    pretty_line += ' ' + ' ' * len(kwd)
-
-            print(pretty_line)
+            print(' '.join(
+                [cpv.ljust(max_len)] +
+                [kwd if kwd in kws else ' ' * len(kwd) for kwd in kws_all]
+            ))
 
         if len(dep_set) > 1:
             print()
@@ -409,6 +464,44 @@ def print_cpv_kws(cpv_kws):
     return
 
 
+def process_cp(cp, args):
+    """Build the lists of CPV-Keywords needed for every slot of `cp`."""
+    cpv_kws = []
+
+    # Convert line to CPV(s)
+    if portage.catpkgsplit(cp):
+        # cat/pkg is already a categ/pkg-ver
+        cpvs = [cp]
+    else:
+        # Get all the atoms matching the given CP
+        cpvs = match_wanted_atoms(cp, release=args.new_version)
+
+    for cpv in get_per_slot_cpvs(cpvs):
+        if not cpv:
+            logger.warn('%s is an invalid CPV', cpv)
+            continue
+
+        kws_missing = max_kws(cpv, release=args.old_version)
+        if kws_missing is None:
+            logger.info('No versions with stable keywords for %s', cpv)
+            # No cpv with stable keywords => select latest
+            arches = make_unstable(ARCHES)
+            kws_missing = [kw[1:] for kw in get_kws(cpv, arches)]
+
+        elif not kws_missing:
+            # Current cpv has the max keywords => nothing to do
+            logger.info('CPV %s is already %s, ignoring', cpv,
+                        'stable' if STABLE else 'keyworded')
+            continue
+
+        cpv_kws.append(
+            gen_cpv_kws(cpv, kws_missing, args.check_dependencies,
+                        args.new_version)
+        )
+
+    return cpv_kws
+
+
 #####################
 # Use the Functions #
 #####################
@@ -426,6 +519,9 @@ def main():
                              ' add them to the list')
     parser.add_argument('--append-slots', action='store_true', default=False,
                         help='Append slots to CPVs output')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Number of CPs to process in parallel'
+                             ' (default: number of CPUs)')
     parser.add_argument('file', help='File to read CP from')
     parser.add_argument('old_version', nargs='?',
                         help='An optional argument specifying which release'
@@ -464,47 +560,24 @@ def main():
         },
     })
 
-    all_cpv_kws = []
-    for line in open(args.file).readlines():
-        cp = line.strip()
-
+    with open(args.file) as cp_file:
         # Filter useless lines
-        if not cp or cp.startswith('#'):
-            continue
-
-        if '#' in cp:
-            raise Exception('Inline comments are not supported')
-
-        # Convert line to CPV(s)
-        if portage.catpkgsplit(cp):
-            # cat/pkg is already a categ/pkg-ver
-            cpvs = [cp]
-        else:
-            # Get all the atoms matching the given CP
-            cpvs = match_wanted_atoms(cp, release=args.new_version)
-
-        for cpv in get_per_slot_cpvs(cpvs):
-            if not cpv:
-                logger.warn('%s is an invalid CPV', cpv)
-                continue
-
-            kws_missing = max_kws(cpv, release=args.old_version)
-            if kws_missing is None:
-                logger.info('No versions with stable keywords for %s', cpv)
-                # No cpv with stable keywords => select latest
-                arches = make_unstable(ARCHES)
-                kws_missing = [kw[1:] for kw in get_kws(cpv, arches)]
-
-            elif not kws_missing:
-                # Current cpv has the max keywords => nothing to do
-                logger.info('CPV %s is already %s, ignoring', cpv,
-                            'stable' if STABLE else 'keyworded')
-                continue
-
-            all_cpv_kws.append(
-                gen_cpv_kws(cpv, kws_missing, set([cpv]),
-                            args.check_dependencies, args.new_version)
-            )
+        cps = [cp for cp in (line.strip() for line in cp_file)
+               if cp and not cp.startswith('#')]
+
+    if any('#' in cp for cp in cps):
+        raise Exception('Inline comments are not supported')
+
+    # Each CP is processed independently, so spread them over several
+    # processes to overlap metadata lookups
+    pool = multiprocessing.Pool(args.jobs)
+    try:
+        results = pool.map(functools.partial(process_cp, args=args), cps)
+    finally:
+        pool.close()
+        pool.join()
+
+    all_cpv_kws = [cpv_kws for result in results for cpv_kws in result]
 
     all_cpv_kws = consolidate_dupes(all_cpv_kws)
     if args.append_slots: